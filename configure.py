@@ -26,19 +26,19 @@ def read_env_file(env_path=".env"):
         return None
 
     with open(env_path, 'r') as f:
-        for line in f:
-            line = line.strip()
+        lines = f.read().splitlines()
 
-            # Skip comments and empty lines
-            if not line or line.startswith('#'):
-                continue
+    for line in lines:
+        line = line.strip()
 
-            # Parse KEY=VALUE
-            if '=' in line:
-                key, value = line.split('=', 1)
-                key = key.strip()
-                value = value.strip()
-                config[key] = value
+        # Skip comments and empty lines
+        if not line or line.startswith('#'):
+            continue
+
+        # Parse KEY=VALUE
+        key, sep, value = line.partition('=')
+        if sep:
+            config[key.strip()] = value.strip()
 
     return config
 
@@ -79,10 +79,11 @@ def generate_config_header(config, output_path="include/config_local.h"):
         if server:
             f.write(f'#define WEBSOCKET_SERVER "{escape_string(server)}"\n')
             # Extract port from URL if present (e.g., ws://host:8280)
-            import re
-            port_match = re.search(r':(\d+)', server.replace('ws://', '').replace('wss://', ''))
-            if port_match:
-                port = port_match.group(1)
+            host = server.split('://', 1)[-1]
+            for delimiter in '/?#':
+                host = host.split(delimiter, 1)[0]
+            _, sep, port = host.rpartition('@')[-1].rpartition(':')
+            if sep and port.isascii() and port.isdigit():
                 f.write(f'#define WEBSOCKET_PORT {port}\n')
 
         # Device Name
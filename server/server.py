@@ -1,12 +1,22 @@
 #!/usr/bin/env python3
 """WiFi Walkie-Talkie Signaling Bridge Server - Peer-to-Peer WebRTC"""
-import asyncio, glob, json, logging, os, time, wave
+import asyncio, glob, json, logging, os, struct, time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Dict, Optional, Set, List
+from functools import lru_cache
+from typing import Dict, Optional, Set
 from collections import deque
 import websockets
+from websockets.frames import OP_BINARY, OP_TEXT
 from websockets.server import serve
 
+try:
+    import orjson
+    encode_json, decode_json = orjson.dumps, orjson.loads
+except ImportError:
+    def encode_json(obj) -> bytes: return json.dumps(obj).encode()
+    decode_json = json.loads
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
@@ -15,11 +25,24 @@ HOST = '0.0.0.0'
 TURN_SERVER = os.environ.get('TURN_SERVER', 'wifi-talkie.spottenn.com:3478')
 TURN_USER = os.environ.get('TURN_USER', 'walkie')
 TURN_PASSWORD = os.environ.get('TURN_PASSWORD', 'talkie')
+TURN_CONFIG = {'urls': f'turn:{TURN_SERVER}', 'username': TURN_USER, 'credential': TURN_PASSWORD}
 RECORDING_ENABLED = True
 RECORDINGS_DIR = os.path.join(os.path.dirname(__file__), 'recordings')
 SAMPLE_RATE = 16000
 SAMPLE_WIDTH = 2
 CHANNELS = 1
+OUTBOX_LIMIT = 64  # audio frames (~2 s); a slower device drops its oldest audio, never control messages
+
+@lru_cache(maxsize=64)
+def frame_header(opcode: int, length: int) -> bytes:
+    """Audio packets have a fixed size, so their header is almost always a cache hit"""
+    if length < 126: return struct.pack('!BB', 0x80 | opcode, length)
+    if length < 65536: return struct.pack('!BBH', 0x80 | opcode, 126, length)
+    return struct.pack('!BBQ', 0x80 | opcode, 127, length)
+
+def encode_frame(opcode: int, payload: bytes) -> bytes:
+    """Unmasked server-to-client frame (RFC 6455), built once and shared by all recipients"""
+    return frame_header(opcode, len(payload)) + payload
 
 class DeviceConnection:
     def __init__(self, websocket, device_name: str):
@@ -27,19 +50,89 @@ class DeviceConnection:
         self.device_name = device_name
         self.is_transmitting = False
         self.connected_at = datetime.now()
+        self.outbox: deque = deque()
+        self.queued_audio = 0
+        self.wake: Optional[asyncio.Future] = None
+        self.writer: Optional[asyncio.Task] = None
+
+    def queue(self, opcode: int, payload: bytes, frame: bytes):
+        self.outbox.append((opcode, payload, frame))
+        if opcode == OP_BINARY:
+            self.queued_audio += 1
+            if self.queued_audio > OUTBOX_LIMIT: self.drop_oldest_audio()
+        if self.wake and not self.wake.done(): self.wake.set_result(None)
+
+    def drop_oldest_audio(self):
+        for i, (opcode, _, _) in enumerate(self.outbox):
+            if opcode == OP_BINARY:
+                del self.outbox[i]
+                self.queued_audio -= 1
+                return
+
+    async def drain_outbox(self):
+        ws = self.websocket
+        # Writing pre-built frames to the transport relies on the legacy protocol of websockets 12
+        # (transport, drain(), open); any other connection type goes through the public send()
+        raw = all(hasattr(ws, attr) for attr in ('transport', 'drain', 'open'))
+        try:
+            while not raw or ws.open:
+                if self.outbox:
+                    # One FIFO keeps signalling and audio in arrival order; only audio is ever evicted
+                    pending = list(self.outbox)
+                    self.outbox.clear()
+                    self.queued_audio = 0
+                    if raw:
+                        # A backlog of pre-built frames goes out in a single transport write
+                        ws.transport.writelines([frame for _, _, frame in pending])
+                        await ws.drain()
+                    else:
+                        for opcode, payload, _ in pending: await ws.send(payload.decode() if opcode == OP_TEXT else payload)
+                else:
+                    self.wake = asyncio.get_running_loop().create_future()
+                    await self.wake
+        except websockets.exceptions.ConnectionClosed: pass
 
 class TransmissionRecording:
     def __init__(self, device_name: str):
         self.device_name = device_name
-        self.audio_data: List[bytes] = []
         self.start_time = datetime.now()
         self.filename: Optional[str] = None
+        self.file = None
+        self.wav = None
+        self.failed = False
+
+    def write(self, audio_data: bytes):
+        if self.failed: return
+        try:
+            if not self.wav:
+                import wave
+                # Open the file ourselves so a failed open leaves no half-built Wave_write behind
+                self.file = open(self.filename, 'wb')
+                self.wav = wave.open(self.file, 'wb')
+                self.wav.setnchannels(CHANNELS); self.wav.setsampwidth(SAMPLE_WIDTH)
+                self.wav.setframerate(SAMPLE_RATE)
+            self.wav.writeframesraw(audio_data)
+        except Exception as e:
+            self.failed = True
+            logger.error(f'Save error: {e}')
+
+    def close(self):
+        if not self.file: return
+        try:
+            if self.wav: self.wav.close()
+            if not self.failed: logger.info(f'Saved: {self.filename}')
+        except Exception as e: logger.error(f'Save error: {e}')
+        finally: self.file.close()
 
 class SignalingBridge:
     def __init__(self):
         self.devices: Dict = {}
         self.current_recording: Optional[TransmissionRecording] = None
         self.transmitting_devices: Set[str] = set()
+        self.receivers: Set[DeviceConnection] = set()
+        self.recording_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='recording')
+        self.handlers = {'register': self.handle_register, 'ptt_start': self.handle_ptt_start, 'ptt_end': self.handle_ptt_end,
+                         'offer': self.handle_offer, 'answer': self.handle_answer, 'candidate': self.handle_candidate}
 
     def ensure_recordings_directory(self):
         if RECORDING_ENABLED and not os.path.exists(RECORDINGS_DIR):
@@ -53,37 +146,35 @@ class SignalingBridge:
         self.current_recording.filename = os.path.join(RECORDINGS_DIR, f'transmission_{timestamp}_{device_name}.wav')
 
     def add_audio_packet(self, audio_data: bytes):
-        if self.current_recording: self.current_recording.audio_data.append(audio_data)
+        # Packets are appended to the WAV file as they arrive, on the recording thread
+        if self.current_recording: self.recording_executor.submit(self.current_recording.write, audio_data)
 
     def save_recording(self):
-        if not self.current_recording or not self.current_recording.audio_data:
-            self.current_recording = None
-            return
-        combined = b''.join(self.current_recording.audio_data)
-        try:
-            with wave.open(self.current_recording.filename, 'wb') as f:
-                f.setnchannels(CHANNELS); f.setsampwidth(SAMPLE_WIDTH)
-                f.setframerate(SAMPLE_RATE); f.writeframes(combined)
-            logger.info(f'Saved: {self.current_recording.filename}')
-        except Exception as e: logger.error(f'Save error: {e}')
-        finally: self.current_recording = None
+        recording, self.current_recording = self.current_recording, None
+        if recording: self.recording_executor.submit(recording.close)
 
     async def broadcast_message(self, message: dict, exclude=None):
-        msg_str = json.dumps(message)
-        for ws, dev in list(self.devices.items()):
-            if ws != exclude:
-                try: await ws.send(msg_str)
-                except: pass
+        payload = encode_json(message)
+        frame = encode_frame(OP_TEXT, payload)
+        for ws, dev in self.devices.items():
+            if ws is not exclude: dev.queue(OP_TEXT, payload, frame)
 
     async def handle_register(self, websocket, data: dict):
         device_name = data.get('device', f'device_{id(websocket)}')
-        self.devices[websocket] = DeviceConnection(websocket, device_name)
+        previous = self.devices.get(websocket)
+        if previous:
+            previous.writer.cancel()
+            self.receivers.discard(previous)
+        device = self.devices[websocket] = DeviceConnection(websocket, device_name)
+        device.writer = asyncio.create_task(device.drain_outbox())
+        self.receivers.add(device)
         logger.info(f'Device registered: {device_name} (total: {len(self.devices)})')
         all_devices = [d.device_name for d in self.devices.values()]
-        await websocket.send(json.dumps({
+        payload = encode_json({
             'type': 'registered', 'device': device_name, 'devices': all_devices,
-            'turn': {'urls': f'turn:{TURN_SERVER}', 'username': TURN_USER, 'credential': TURN_PASSWORD}
-        }))
+            'turn': TURN_CONFIG
+        })
+        device.queue(OP_TEXT, payload, encode_frame(OP_TEXT, payload))
         await self.broadcast_message({'type': 'device_joined', 'device': device_name, 'clients': len(self.devices)}, exclude=websocket)
 
     async def handle_ptt_start(self, websocket, data: dict):
@@ -91,6 +182,7 @@ class SignalingBridge:
         if not device: return
         device.is_transmitting = True
         self.transmitting_devices.add(device.device_name)
+        self.receivers.discard(device)
         logger.info(f'PTT START: {device.device_name}')
         if len(self.transmitting_devices) == 1: self.start_recording(device.device_name)
         await self.broadcast_message({'type': 'ptt_start', 'device': device.device_name})
@@ -100,6 +192,7 @@ class SignalingBridge:
         if not device: return
         device.is_transmitting = False
         self.transmitting_devices.discard(device.device_name)
+        self.receivers.add(device)
         logger.info(f'PTT END: {device.device_name}')
         if len(self.transmitting_devices) == 0: self.save_recording()
         await self.broadcast_message({'type': 'ptt_end', 'device': device.device_name})
@@ -125,23 +218,20 @@ class SignalingBridge:
         device = self.devices.get(websocket)
         if not device or not device.is_transmitting: return
         self.add_audio_packet(audio_bytes)
-        for ws, dev in list(self.devices.items()):
-            if ws != websocket and not dev.is_transmitting:
-                try: await ws.send(audio_bytes)
-                except: pass
+        frame = encode_frame(OP_BINARY, audio_bytes)
+        for dev in self.receivers: dev.queue(OP_BINARY, audio_bytes, frame)
 
     async def handle_message(self, websocket, message):
         if isinstance(message, bytes):
             await self.handle_audio_data(websocket, message)
             return
         try:
-            data = json.loads(message)
+            data = decode_json(message)
             msg_type = data.get('type', '')
-            device = self.devices.get(websocket)
-            logger.info(f"Received: {msg_type} from {device.device_name if device else 'unknown'}")
-            handlers = {'register': self.handle_register, 'ptt_start': self.handle_ptt_start, 'ptt_end': self.handle_ptt_end,
-                       'offer': self.handle_offer, 'answer': self.handle_answer, 'candidate': self.handle_candidate}
-            handler = handlers.get(msg_type)
+            if logger.isEnabledFor(logging.DEBUG):
+                device = self.devices.get(websocket)
+                logger.debug(f"Received: {msg_type} from {device.device_name if device else 'unknown'}")
+            handler = self.handlers.get(msg_type)
             if handler: await handler(websocket, data)
             else: logger.warning(f'Unknown: {msg_type}')
         except json.JSONDecodeError as e: logger.error(f'Invalid JSON: {e}')
@@ -155,6 +245,8 @@ class SignalingBridge:
         finally:
             device = self.devices.pop(websocket, None)
             if device:
+                device.writer.cancel()
+                self.receivers.discard(device)
                 self.transmitting_devices.discard(device.device_name)
                 logger.info(f'Device disconnected: {device.device_name}')
                 await self.broadcast_message({'type': 'device_left', 'device': device.device_name, 'clients': len(self.devices)})
@@ -163,12 +255,17 @@ class SignalingBridge:
     async def run(self):
         logger.info('WiFi Walkie-Talkie Signaling Bridge')
         logger.info(f'Listening on {HOST}:{PORT}, TURN: {TURN_SERVER}')
-        async with serve(self.handle_connection, HOST, PORT): await asyncio.Future()
+        async with serve(self.handle_connection, HOST, PORT, compression=None, max_size=2**16, max_queue=16):
+            await asyncio.Future()
 
 async def main():
     bridge = SignalingBridge()
     await bridge.run()
 
 if __name__ == '__main__':
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError: pass
     try: asyncio.run(main())
     except KeyboardInterrupt: logger.info('Server stopped')